@@ -16,6 +16,9 @@ def main():
 
     args = parser.parse_args()
 
+    # Reuse the connection to Kent across files
+    session = requests.Session()
+
     for fn in args.file:
         with open(fn, "r") as fp:
             data = json.load(fp)
@@ -24,7 +27,7 @@ def main():
                 data = data["payload"]
 
             print(f"Submitting {fn}...")
-            resp = requests.post(
+            resp = session.post(
                 f"http://{args.host}:{args.port}/api/0/store/", json=data
             )
             resp.raise_for_status()
@@ -2,21 +2,30 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
-from dataclasses import dataclass
+from collections import deque
+from dataclasses import dataclass, field
 import datetime
-import gzip
-import json
+import functools
 import logging
 from logging.config import dictConfig
 import os
+import threading
 from typing import Optional, Union
-import uuid
-import zlib
 
-from flask import Flask, request, render_template
+from flask import Flask, request, Response
+from flask.json.provider import JSONProvider
+from werkzeug.exceptions import BadRequest, RequestEntityTooLarge
 
 from kent import __version__
-from kent.utils import parse_envelope
+from kent.utils import json_dumps, json_loads, orjson, parse_envelope
+
+
+# Use isal for decompressing payloads if it's available since it's a lot faster
+# than the stdlib zlib module
+try:
+    from isal import isal_zlib as zlib
+except ImportError:
+    import zlib
 
 
 dictConfig(
@@ -49,17 +58,120 @@ dictConfig(
 BANNER = None
 
 
-def deep_get(structure, path, default=None):
-    node = structure
-    for part in path.split("."):
-        if part.startswith("["):
-            index = int(part[1:-1])
-            node = node[index]
-        elif part in node:
-            node = node[part]
+class OrjsonProvider(JSONProvider):
+    """Flask JSON provider that uses orjson for API responses
+
+    Keys are sorted like they are with Flask's default provider. Keyword
+    arguments to ``dumps`` and ``loads`` (``indent``, ``sort_keys``, etc) are
+    ignored since orjson doesn't support the stdlib json module's options.
+
+    """
+
+    mimetype = "application/json"
+
+    def dumps(self, obj, **kwargs):
+        return json_dumps(obj).decode("utf-8")
+
+    def loads(self, s, **kwargs):
+        return json_loads(s)
+
+    def response(self, *args, **kwargs):
+        if args and kwargs:
+            raise TypeError("app.json.response() takes either args or kwargs, not both")
+
+        if not args and not kwargs:
+            obj = None
+        elif len(args) == 1:
+            obj = args[0]
         else:
-            return default
-    return node
+            obj = args or kwargs
+
+        # Pass the bytes orjson produces straight to the response rather than
+        # going through dumps which decodes them to a str
+        return self._app.response_class(json_dumps(obj), mimetype=self.mimetype)
+
+
+def get_sdk_info(body):
+    """Returns the name and version of the sentry sdk that sent the payload
+
+    :arg body: the decoded payload body
+
+    :returns: (name, version) tuple; either can be None
+
+    """
+    # Attachment bodies aren't dicts, so they don't have sdk information
+    if type(body) is not dict:
+        return None, None
+    sdk = body.get("sdk")
+    if type(sdk) is not dict:
+        return None, None
+    return sdk.get("name"), sdk.get("version")
+
+
+# Size of chunks to read from the request stream when decompressing bodies
+READ_BUFFER_SIZE = 128 * 1024
+
+# Maximum size of a decompressed body; this keeps a tiny compressed payload from
+# inflating into something that eats all the memory
+MAX_BODY_SIZE = 50 * 1024 * 1024
+
+# Map of content-encoding -> zlib wbits for decompressing bodies with that
+# encoding
+CONTENT_ENCODING_WBITS = {
+    "gzip": 16 + zlib.MAX_WBITS,
+    "deflate": zlib.MAX_WBITS,
+}
+
+
+def read_body(req):
+    """Reads the request body and decompresses it if it's gzip or deflate encoded
+
+    This streams the body from the request into the decompressor so we don't
+    hold a compressed copy of the whole body in memory.
+
+    :arg req: the Flask request
+
+    :returns: the body as bytes or bytearray
+
+    :raises RequestEntityTooLarge: if the decompressed body is larger than
+        MAX_BODY_SIZE
+    :raises BadRequest: if the body can't be decompressed or is truncated
+
+    """
+    wbits = CONTENT_ENCODING_WBITS.get(req.headers.get("content-encoding"))
+    if wbits is None:
+        # Don't cache the body on the request; we only read it once
+        return req.get_data(cache=False)
+
+    decompressor = zlib.decompressobj(wbits)
+    body = bytearray()
+    try:
+        while True:
+            chunk = req.stream.read(READ_BUFFER_SIZE)
+            if not chunk:
+                break
+            while chunk:
+                if decompressor.eof:
+                    if wbits != CONTENT_ENCODING_WBITS["gzip"]:
+                        # zlib.decompress ignores data after the end of a
+                        # deflate stream, so we do, too
+                        break
+                    # A gzip body can have multiple members; start a new
+                    # decompressor for the next one
+                    decompressor = zlib.decompressobj(wbits)
+                # Limit the output to one byte over the max so we know when
+                # it's too big
+                body += decompressor.decompress(chunk, MAX_BODY_SIZE + 1 - len(body))
+                if len(body) > MAX_BODY_SIZE:
+                    raise RequestEntityTooLarge()
+                # Anything after the end of this member is the next member
+                chunk = decompressor.unused_data
+    except zlib.error as exc:
+        raise BadRequest(f"Could not decompress body: {exc}") from exc
+
+    if not decompressor.eof:
+        raise BadRequest("Could not decompress body: compressed data is truncated")
+    return body
 
 
 @dataclass
@@ -76,49 +188,75 @@ class Event:
     # datastructures
     body: Optional[Union[dict, bytes]] = None
 
+    # Cached summary; the body doesn't change after the event is added, so this
+    # only needs to be computed once
+    _summary: Optional[str] = field(default=None, init=False, repr=False, compare=False)
+    # Cached JSON-encoded to_dict() output as bytes
+    _json: Optional[bytes] = field(default=None, init=False, repr=False, compare=False)
+    # Timestamp from the body or when Kent received the event
+    _timestamp: str = field(default="", init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        # NOTE(willkg): timestamp is a string
+        timestamp = None
+        if type(self.body) is dict:
+            timestamp = self.body.get("timestamp")
+        self._timestamp = timestamp or str(datetime.datetime.now())
+
     @property
     def summary(self):
-        if not self.body:
+        if self._summary is None:
+            self._summary = self._compute_summary()
+        return self._summary
+
+    def _compute_summary(self):
+        body = self.body
+        # body is either bytes (attachments) or whatever the JSON decoder
+        # returned, so checking the exact type is fine and it's faster than
+        # isinstance
+        if not body or type(body) is not dict:
             return "no summary"
 
-        if isinstance(self.body, dict):
-            # Kent body parsing errors
-            kent_error = self.body.get("error")
-            if kent_error:
-                return kent_error
+        # Kent body parsing errors
+        kent_error = body.get("error")
+        if kent_error:
+            return kent_error
 
-            # Sentry exceptions events
-            exceptions = deep_get(self.body, "exception.values", default=[])
+        # Sentry exceptions events
+        exception = body.get("exception")
+        if type(exception) is dict:
+            exceptions = exception.get("values")
             if exceptions:
                 first = exceptions[0]
                 return f"{first['type']}: {first['value']}"
 
-            # Sentry message
-            msg = deep_get(self.body, "message", default=None)
-            if msg:
-                return msg
-
-            # CSP security report (older browsers--single report per payload)
-            if "csp-report" in self.body:
-                directive = deep_get(
-                    self.body, "csp-report.violated-directive", default="unknown"
-                )
-                summary = f"csp-report: {directive}"
-                return summary
-
-            if self.body.get("type") == "csp-violation":
-                directive = deep_get(
-                    self.body, "body.effectiveDirective", default="unknown"
-                )
-                summary = f"csp-report: {directive}"
-                return summary
+        # Sentry message
+        msg = body.get("message")
+        if msg:
+            return msg
+
+        # CSP security report (older browsers--single report per payload)
+        if "csp-report" in body:
+            csp_report = body["csp-report"]
+            directive = "unknown"
+            if type(csp_report) is dict:
+                directive = csp_report.get("violated-directive", "unknown")
+            summary = f"csp-report: {directive}"
+            return summary
+
+        if body.get("type") == "csp-violation":
+            report_body = body.get("body")
+            directive = "unknown"
+            if type(report_body) is dict:
+                directive = report_body.get("effectiveDirective", "unknown")
+            summary = f"csp-report: {directive}"
+            return summary
 
         return "no summary"
 
     @property
     def timestamp(self):
-        # NOTE(willkg): timestamp is a string
-        return self.body.get("timestamp") or str(datetime.datetime.now())
+        return self._timestamp
 
     def to_dict(self):
         return {
@@ -131,13 +269,31 @@ class Event:
             },
         }
 
+    def to_json(self):
+        """Returns to_dict() output as JSON-encoded bytes"""
+        if self._json is None:
+            self._json = json_dumps(self.to_dict())
+        return self._json
+
+
+def new_event_id():
+    """Returns a new random event id as a 32-character hex string"""
+    return os.urandom(16).hex()
+
 
 class EventManager:
     MAX_EVENTS = 100
 
     def __init__(self):
-        # List of Event instances
-        self.events = []
+        # Event instances; oldest events are evicted when it's full
+        self.events = deque(maxlen=self.MAX_EVENTS)
+        # Map of event_id -> Event instance for lookups
+        self._by_id = {}
+        # Incremented every time the list of events changes
+        self.generation = 0
+        # Requests are handled in multiple threads, so changes to events and
+        # _by_id happen under this lock
+        self._lock = threading.Lock()
 
     def add_event(
         self, event_id, project_id, envelope_header=None, header=None, body=None
@@ -149,32 +305,46 @@ class EventManager:
             header=header,
             body=body,
         )
-        self.events.append(event)
-
-        while len(self.events) > self.MAX_EVENTS:
-            self.events.pop(0)
+        with self._lock:
+            if len(self.events) == self.events.maxlen:
+                # The deque is going to evict the oldest event, so remove it
+                # from the index, too, unless a newer event with the same id
+                # replaced it
+                oldest = self.events[0]
+                if self._by_id.get(oldest.event_id) is oldest:
+                    del self._by_id[oldest.event_id]
+
+            self.events.append(event)
+            self._by_id[event_id] = event
+            self.generation += 1
         return event
 
     def get_event(self, event_id):
-        for event in self.events:
-            if event.event_id == event_id:
-                return event
-        return None
+        return self._by_id.get(event_id)
 
     def get_events(self):
-        return self.events
+        # Return a copy so callers can iterate over it while other requests
+        # add events
+        with self._lock:
+            return list(self.events)
 
     def flush(self):
-        self.events = []
+        with self._lock:
+            self.events.clear()
+            self._by_id.clear()
+            self.generation += 1
 
 
 EVENTS = EventManager()
 
 
-INTERESTING_HEADERS = [
-    "User-Agent",
-    "X-Sentry-Auth",
-]
+# Headers to log when not in dev mode; these are lowercase
+INTERESTING_HEADERS = frozenset(
+    [
+        "user-agent",
+        "x-sentry-auth",
+    ]
+)
 
 
 def create_app(test_config=None):
@@ -186,6 +356,9 @@ def create_app(test_config=None):
     app = Flask(__name__, instance_relative_config=True)
     app.config.from_mapping(SECRET_KEY="dev")
 
+    if orjson is not None:
+        app.json = OrjsonProvider(app)
+
     if test_config is not None:
         app.config.from_mapping(test_config)
 
@@ -193,16 +366,32 @@ def create_app(test_config=None):
         app.logger.info(BANNER)
 
     if dev_mode:
-        logging.getLogger("kent").setLevel(logging.DEBUG)
+        # Setting the level clears the cache on every logger, so only do it if
+        # it's going to change something
+        kent_logger = logging.getLogger("kent")
+        if kent_logger.level != logging.DEBUG:
+            kent_logger.setLevel(logging.DEBUG)
         app.logger.debug("Dev mode on.")
 
     @app.route("/", methods=["GET"])
     def index_view():
-        host = request.scheme + "://" + request.headers["host"]
-        dsn = request.scheme + "://public@" + request.headers["host"] + "/1"
-
-        return render_template(
-            "index.html",
+        host = request.host_url.rstrip("/")
+        dsn = f"{request.scheme}://public@{request.host}/1"
+
+        if app.jinja_env.auto_reload:
+            # Skip the cache so edits to the template show up right away
+            return render_index.__wrapped__(host, dsn, EVENTS.generation)
+        return render_index(host, dsn, EVENTS.generation)
+
+    @functools.lru_cache(maxsize=16)
+    def render_index(host, dsn, generation):
+        # The events generation changes every time events are added or
+        # flushed, so this only re-renders the page when there's something new
+        # to show. This renders the template directly to skip the context
+        # processors and signals render_template runs since the page doesn't
+        # use them.
+        template = app.jinja_env.get_template("index.html")
+        return template.render(
             host=host,
             dsn=dsn,
             events=EVENTS.get_events(),
@@ -211,16 +400,23 @@ def create_app(test_config=None):
 
     @app.route("/api/event/<event_id>", methods=["GET"])
     def api_event_view(event_id):
-        app.logger.info(f"GET /api/event/{event_id}")
+        app.logger.info("GET /api/event/%s", event_id)
         event = EVENTS.get_event(event_id)
         if event is None:
             return {"error": f"Event {event_id} not found"}, 404
 
-        return event.to_dict()
+        return Response(event.to_json(), mimetype="application/json")
 
     @app.route("/api/eventlist/", methods=["GET"])
     def api_event_list_view():
         app.logger.info("GET /api/eventlist/")
+        return Response(
+            render_event_list(EVENTS.generation), mimetype="application/json"
+        )
+
+    @functools.lru_cache(maxsize=1)
+    def render_event_list(generation):
+        # Like render_index, this only rebuilds the list when events change
         event_ids = [
             {
                 "project_id": event.project_id,
@@ -229,7 +425,7 @@ def create_app(test_config=None):
             }
             for event in EVENTS.get_events()
         ]
-        return {"events": event_ids}
+        return json_dumps({"events": event_ids})
 
     @app.route("/api/flush/", methods=["POST"])
     def api_flush_view():
@@ -238,39 +434,31 @@ def create_app(test_config=None):
         return {"success": True}
 
     def log_headers(dev_mode, error_id, headers):
-        # Log headers
-        if dev_mode:
-            for key, val in headers.items():
+        # Skip all the header work if the log lines are going to get dropped
+        if not app.logger.isEnabledFor(logging.INFO):
+            return
+
+        # Log all headers in dev mode and just the interesting ones otherwise
+        for key, val in headers.items():
+            if dev_mode or key.lower() in INTERESTING_HEADERS:
                 app.logger.info("%s: header: %s: %s", error_id, key, val)
-        else:
-            for key in INTERESTING_HEADERS:
-                if key in headers:
-                    app.logger.info(
-                        "%s: header: %s: %s", error_id, key, request.headers[key]
-                    )
 
     @app.route("/api/<int:project_id>/store/", methods=["POST"])
     def store_view(project_id):
-        app.logger.info(f"POST /api/{project_id}/store/")
-        event_id = str(uuid.uuid4())
+        app.logger.info("POST /api/%s/store/", project_id)
+        event_id = new_event_id()
         log_headers(dev_mode, event_id, request.headers)
 
-        # Decompress it
-        if request.headers.get("content-encoding") == "gzip":
-            body = gzip.decompress(request.data)
-        elif request.headers.get("content-encoding") == "deflate":
-            body = zlib.decompress(request.data)
-        else:
-            body = request.data
+        body = read_body(request)
 
-        app.logger.debug(f"{body}")
+        app.logger.debug("%s", body)
 
         # JSON decode payload
         try:
-            json_body = json.loads(body)
+            json_body = json_loads(body)
         except Exception:
             app.logger.exception("%s: exception when JSON-decoding body.", event_id)
-            app.logger.error("%s: %s", event_id, json_body)
+            app.logger.error("%s: %s", event_id, body)
             EVENTS.add_event(
                 event_id=event_id,
                 project_id=project_id,
@@ -282,42 +470,35 @@ def create_app(test_config=None):
             event_id=event_id, project_id=project_id, body=json_body
         )
 
-        # Log sentry sdk information from payload
+        # Log project id, sentry sdk information from payload, event summary,
+        # and event url
+        event_url = f"{request.host_url}api/event/{event_id}"
+        sdk_name, sdk_version = get_sdk_info(json_body)
         app.logger.info(
-            "%s: sdk: %s %s",
+            "%s: project id: %s, sdk: %s %s, summary: %s, url: %s",
             event_id,
-            deep_get(json_body, "sdk.name"),
-            deep_get(json_body, "sdk.version"),
+            project_id,
+            sdk_name,
+            sdk_version,
+            event.summary,
+            event_url,
         )
 
-        # Log event summary
-        app.logger.info("%s: summary: %s", event_id, event.summary)
-
-        # Log event url
-        event_url = f"{request.scheme}://{request.headers['host']}/api/event/{event_id}"
-        app.logger.info("%s: project id: %s", event_id, project_id)
-        app.logger.info("%s: url: %s", event_id, event_url)
-
         return {"success": True}
 
     @app.route("/api/<int:project_id>/envelope/", methods=["POST"])
     def envelope_view(project_id):
-        app.logger.info(f"POST /api/{project_id}/envelope/")
-        request_id = str(uuid.uuid4())
+        app.logger.info("POST /api/%s/envelope/", project_id)
+        request_id = new_event_id()
         log_headers(dev_mode, request_id, request.headers)
 
-        # Decompress it
-        if request.headers.get("content-encoding") == "gzip":
-            body = gzip.decompress(request.data)
-        elif request.headers.get("content-encoding") == "deflate":
-            body = zlib.decompress(request.data)
-        else:
-            body = request.data
+        body = read_body(request)
 
-        app.logger.debug(f"{body}")
+        app.logger.debug("%s", body)
 
+        event_url_prefix = f"{request.host_url}api/event/"
         for item in parse_envelope(body):
-            event_id = str(uuid.uuid4())
+            event_id = new_event_id()
             event = EVENTS.add_event(
                 event_id=event_id,
                 project_id=project_id,
@@ -326,39 +507,34 @@ def create_app(test_config=None):
                 body=item.body,
             )
 
-            # Log sentry sdk information from payload
+            # Log project id, sentry sdk information from payload, event
+            # summary, and event url
+            sdk_name, sdk_version = get_sdk_info(item.body)
             app.logger.info(
-                "%s: sdk: %s %s",
+                "%s: project id: %s, sdk: %s %s, summary: %s, url: %s",
                 event_id,
-                deep_get(item.body, "sdk.name"),
-                deep_get(item.body, "sdk.version"),
-            )
-
-            # Log event summary
-            app.logger.info("%s: summary: %s", event_id, event.summary)
-
-            # Log event url
-            event_url = (
-                f"{request.scheme}://{request.headers['host']}/api/event/{event_id}"
+                project_id,
+                sdk_name,
+                sdk_version,
+                event.summary,
+                event_url_prefix + event_id,
             )
-            app.logger.info("%s: project id: %s", event_id, project_id)
-            app.logger.info("%s: url: %s", event_id, event_url)
 
         return {"success": True}
 
     @app.route("/api/<int:project_id>/security/", methods=["POST"])
     def security_view(project_id):
-        app.logger.info(f"POST /api/{project_id}/security/")
-        event_id = str(uuid.uuid4())
+        app.logger.info("POST /api/%s/security/", project_id)
+        event_id = new_event_id()
         log_headers(dev_mode, event_id, request.headers)
 
-        body = request.data
+        body = read_body(request)
 
-        app.logger.debug(f"{body}")
+        app.logger.debug("%s", body)
 
         # Decode the JSON payload
         try:
-            json_body = json.loads(body)
+            json_body = json_loads(body)
         except Exception:
             app.logger.exception("%s: exception when JSON-decoding body.", event_id)
             app.logger.error("%s: %s", event_id, body)
@@ -369,6 +545,8 @@ def create_app(test_config=None):
             )
             raise
 
+        event_url = f"{request.host_url}api/event/{event_id}"
+
         if isinstance(json_body, list):
             # Single payload with multiple reports per CSP 3
             for csp_report in json_body:
@@ -376,15 +554,14 @@ def create_app(test_config=None):
                     event_id=event_id, project_id=project_id, body=csp_report
                 )
 
-                # Log event summary
-                app.logger.info("%s: summary: %s", event_id, event.summary)
-
-                # Log event url
-                event_url = (
-                    f"{request.scheme}://{request.headers['host']}/api/event/{event_id}"
+                # Log project id, event summary, and event url
+                app.logger.info(
+                    "%s: project id: %s, summary: %s, url: %s",
+                    event_id,
+                    project_id,
+                    event.summary,
+                    event_url,
                 )
-                app.logger.info("%s: project id: %s", event_id, project_id)
-                app.logger.info("%s: url: %s", event_id, event_url)
 
         else:
             # Old CSP report format where it's a single report
@@ -392,15 +569,14 @@ def create_app(test_config=None):
                 event_id=event_id, project_id=project_id, body=json_body
             )
 
-            # Log event summary
-            app.logger.info("%s: summary: %s", event_id, event.summary)
-
-            # Log event url
-            event_url = (
-                f"{request.scheme}://{request.headers['host']}/api/event/{event_id}"
+            # Log project id, event summary, and event url
+            app.logger.info(
+                "%s: project id: %s, summary: %s, url: %s",
+                event_id,
+                project_id,
+                event.summary,
+                event_url,
             )
-            app.logger.info("%s: project id: %s", event_id, project_id)
-            app.logger.info("%s: url: %s", event_id, event_url)
 
         return {"success": True}
 
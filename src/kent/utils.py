@@ -8,6 +8,33 @@ import json
 from typing import Union
 
 
+# Use orjson for encoding and decoding payloads if it's available since it's a
+# lot faster than the stdlib json module
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# json_dumps produces compact output with sorted keys like Flask's default JSON
+# provider does, so API responses look the same with and without orjson
+if orjson is not None:
+    json_loads = orjson.loads
+
+    def json_dumps(obj):
+        return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS)
+
+else:
+
+    def json_loads(data):
+        # The stdlib json module doesn't decode memoryviews
+        if isinstance(data, memoryview):
+            data = data.tobytes()
+        return json.loads(data)
+
+    def json_dumps(obj):
+        return json.dumps(obj, sort_keys=True, separators=(",", ":")).encode("utf-8")
+
+
 LOGGER = logging.getLogger(__name__)
 
 
@@ -18,15 +45,21 @@ class Item:
     body: Union[dict, bytes]
 
 
-def get_newline_index(body, start_index, end_index):
+def get_newline_index(body, start_index):
+    """Returns the index of the next newline at or after start_index
+
+    :arg body: the envelope payload body
+    :arg start_index: the index to start looking at
+
+    :returns: index of the newline or the length of the body if there isn't
+        one
+
+    """
     end_index = body.find(b"\n", start_index)
     if end_index == -1:
         # If there are no more \n, then the end_index is the last index in the
         # body
         end_index = len(body)
-    else:
-        while body[end_index] == "\r":
-            end_index = body.find(b"\n", end_index + 1)
     return end_index
 
 
@@ -39,6 +72,9 @@ def parse_envelope(body):
 
     """
 
+    # Slices of the memoryview share memory with the body, so passing them to
+    # the JSON decoder doesn't copy anything
+    view = memoryview(body)
     body_length = len(body)
     start_index = end_index = 0
     read_length = -1
@@ -49,20 +85,20 @@ def parse_envelope(body):
     # See: https://develop.sentry.dev/sdk/envelopes/
     while end_index < body_length:
         start_index = end_index
-        end_index = get_newline_index(body, start_index, end_index)
+        end_index = get_newline_index(body, start_index)
 
         if envelope_header is None:
-            envelope_header = json.loads(body[start_index:end_index])
+            envelope_header = json_loads(view[start_index:end_index])
             end_index += 1
             continue
 
-        json_part = body[start_index:end_index]
+        json_part = view[start_index:end_index]
 
         try:
-            part = json.loads(json_part)
+            part = json_loads(json_part)
         except Exception:
             LOGGER.exception("exception when JSON-decoding body.")
-            LOGGER.error("%s", json_part)
+            LOGGER.error("%s", bytes(json_part))
             raise
 
         if "type" in part:
@@ -75,21 +111,23 @@ def parse_envelope(body):
                 # NOTE(willkg): This will include the newline separater at the end
                 end_index = end_index + read_length
             else:
-                end_index = get_newline_index(body, start_index, end_index)
+                end_index = get_newline_index(body, start_index)
 
             # NOTE(willkg): This drops the newline separator because it's not
             # part of the Item body
-            item_body = body[start_index:end_index]
+            item_body = view[start_index:end_index]
 
             if part.get("type") == "attachment":
+                # Copy attachments into bytes so the item doesn't hold onto
+                # the whole envelope body
                 yield Item(
                     envelope_header=envelope_header,
                     header=part,
-                    body=item_body,
+                    body=bytes(item_body),
                 )
 
             else:
-                item_body_data = json.loads(item_body)
+                item_body_data = json_loads(item_body)
                 yield Item(
                     envelope_header=envelope_header, header=part, body=item_body_data
                 )
@@ -2,10 +2,16 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import gzip
+import json
+import threading
+import zlib
+
 import pytest
 import uuid
 
-from kent.app import create_app, Event
+import kent.app
+from kent.app import create_app, Event, EventManager, get_sdk_info
 
 
 @pytest.fixture
@@ -16,6 +22,29 @@ def client():
         yield client
 
 
+@pytest.mark.parametrize(
+    "body, expected",
+    [
+        (
+            {"sdk": {"name": "sentry.python", "version": "2.2.0"}},
+            ("sentry.python", "2.2.0"),
+        ),
+        ({}, (None, None)),
+        ({"sdk": None}, (None, None)),
+        ({"sdk": "sentry.python"}, (None, None)),
+        ({"sdk": ["sentry.python"]}, (None, None)),
+        (b"some attachment", (None, None)),
+    ],
+)
+def test_get_sdk_info(body, expected):
+    assert get_sdk_info(body) == expected
+
+
+def test_store_view_sdk_not_a_dict(client):
+    resp = client.post("/api/1/store/", json={"sdk": "x", "message": "m"})
+    assert resp.status_code == 200
+
+
 class TestEvent:
     @pytest.mark.parametrize(
         "payload, expected",
@@ -40,6 +69,31 @@ class TestEvent:
                 },
                 "some message",
             ),
+            # Exception that isn't a dict
+            ({"exception": [{"type": "Exception", "value": "boom"}]}, "no summary"),
+            ({"exception": "boom"}, "no summary"),
+            ({"exception": "boom", "message": "some message"}, "some message"),
+            # Kent error
+            (
+                {"error": "Kent could not decode body; see logs"},
+                "Kent could not decode body; see logs",
+            ),
+            # Old-style CSP report
+            (
+                {"csp-report": {"violated-directive": "script-src"}},
+                "csp-report: script-src",
+            ),
+            # New-style CSP report
+            (
+                {"type": "csp-violation", "body": {"effectiveDirective": "img-src"}},
+                "csp-report: img-src",
+            ),
+            # CSP reports with unexpected shapes
+            ({"csp-report": "script-src"}, "csp-report: unknown"),
+            ({"csp-report": None}, "csp-report: unknown"),
+            ({"type": "csp-violation", "body": None}, "csp-report: unknown"),
+            # Attachment
+            (b"some attachment", "no summary"),
         ],
     )
     def test_summary(self, payload, expected):
@@ -50,12 +104,136 @@ class TestEvent:
         )
         assert event.summary == expected
 
+    def test_timestamp(self):
+        event = Event(
+            project_id="0",
+            event_id="9884b351-1e8f-4a28-8a9a-fc0033467e4e",
+            body={"timestamp": "2024-05-19T03:13:43.015857Z"},
+        )
+        assert event.timestamp == "2024-05-19T03:13:43.015857Z"
+
+    @pytest.mark.parametrize("payload", [{}, b"some attachment"])
+    def test_timestamp_missing(self, payload):
+        event = Event(
+            project_id="0",
+            event_id="9884b351-1e8f-4a28-8a9a-fc0033467e4e",
+            body=payload,
+        )
+        # Falls back to when the event was created and doesn't change
+        assert event.timestamp
+        assert event.timestamp == event.timestamp
+
+
+class TestEventManager:
+    def test_evicts_oldest_events(self):
+        event_manager = EventManager()
+        for i in range(EventManager.MAX_EVENTS + 5):
+            event_manager.add_event(event_id=str(i), project_id=1, body={})
+
+        events = event_manager.get_events()
+        assert len(events) == EventManager.MAX_EVENTS
+        assert events[0].event_id == "5"
+        assert event_manager.get_event("4") is None
+        assert event_manager.get_event("5") is not None
+
+    def test_get_event_duplicate_id_survives_eviction(self):
+        # security_view adds every CSP report in a payload with the same event id
+        event_manager = EventManager()
+        event_manager.add_event(event_id="dupe", project_id=1, body={})
+        newer = event_manager.add_event(event_id="dupe", project_id=1, body={})
+        for i in range(EventManager.MAX_EVENTS - 1):
+            event_manager.add_event(event_id=str(i), project_id=1, body={})
+
+        assert event_manager.get_event("dupe") is newer
+
+    def test_concurrent_add_event(self):
+        event_manager = EventManager()
+
+        def add_events(prefix):
+            for i in range(1000):
+                event_manager.add_event(event_id=f"{prefix}-{i}", project_id=1)
+
+        threads = [
+            threading.Thread(target=add_events, args=(str(i),)) for i in range(4)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        events = event_manager.get_events()
+        assert len(events) == EventManager.MAX_EVENTS
+        assert len(event_manager._by_id) == EventManager.MAX_EVENTS
+        for event in events:
+            assert event_manager.get_event(event.event_id) is event
+
+    def test_flush(self):
+        event_manager = EventManager()
+        event_manager.add_event(event_id="1", project_id=1, body={})
+        event_manager.flush()
+        assert len(event_manager.get_events()) == 0
+        assert event_manager.get_event("1") is None
+
+
+def test_log_headers(client, caplog):
+    resp = client.post(
+        "/api/1/store/",
+        json={"message": "some message"},
+        headers={"X-Sentry-Auth": "Sentry sentry_key=public", "X-Other": "other"},
+    )
+    assert resp.status_code == 200
+
+    messages = [record.getMessage() for record in caplog.records]
+    assert any(
+        msg.endswith(": header: X-Sentry-Auth: Sentry sentry_key=public")
+        for msg in messages
+    )
+    assert not any("X-Other" in msg for msg in messages)
+
 
 def test_index_view(client):
     resp = client.get("/")
     assert b"Kent" in resp.data
 
 
+def test_index_view_auto_reload(client, monkeypatch):
+    app = client.application
+    app.jinja_env.auto_reload = True
+    resp = client.get("/")
+    assert b"Kent" in resp.data
+
+    # With auto reload on, the page is rendered every time
+    render_calls = []
+    original_get_template = app.jinja_env.get_template
+
+    def get_template(name):
+        render_calls.append(name)
+        return original_get_template(name)
+
+    monkeypatch.setattr(app.jinja_env, "get_template", get_template)
+    client.get("/")
+    client.get("/")
+    assert render_calls == ["index.html", "index.html"]
+
+
+def test_index_view_shows_new_events(client):
+    resp = client.get("/")
+    assert b"There are 0 events in memory." in resp.data
+
+    resp = client.post("/api/1/store/", json={"message": "some message"})
+    assert resp.status_code == 200
+
+    resp = client.get("/")
+    assert b"There are 1 events in memory." in resp.data
+    assert b"some message" in resp.data
+
+    resp = client.post("/api/flush/")
+    assert resp.status_code == 200
+
+    resp = client.get("/")
+    assert b"There are 0 events in memory." in resp.data
+
+
 # From "kent-testpost" message with Python sentry-sdk 1.45.0
 SENTRY_SDK_1_45_0_ERROR = {
     "breadcrumbs": {"values": []},
@@ -128,6 +306,88 @@ def test_store_view(client):
     assert resp.status_code == 200
 
 
+@pytest.mark.parametrize(
+    "content_encoding, compress",
+    [
+        ("gzip", gzip.compress),
+        ("deflate", zlib.compress),
+    ],
+)
+def test_store_view_compressed(client, content_encoding, compress):
+    resp = client.post(
+        "/api/1/store/",
+        content_type="application/json",
+        headers={"Content-Encoding": content_encoding},
+        data=compress(json.dumps(SENTRY_SDK_1_45_0_ERROR).encode("utf-8")),
+    )
+    assert resp.status_code == 200
+
+    resp = client.get("/api/eventlist/")
+    event_id = resp.json["events"][0]["event_id"]
+    resp = client.get(f"/api/event/{event_id}")
+    assert resp.json["payload"]["body"] == SENTRY_SDK_1_45_0_ERROR
+
+
+@pytest.mark.parametrize(
+    "content_encoding, compress",
+    [
+        ("gzip", gzip.compress),
+        ("deflate", zlib.compress),
+    ],
+)
+def test_store_view_compressed_too_large(
+    client, monkeypatch, content_encoding, compress
+):
+    monkeypatch.setattr(kent.app, "MAX_BODY_SIZE", 100)
+    resp = client.post(
+        "/api/1/store/",
+        content_type="application/json",
+        headers={"Content-Encoding": content_encoding},
+        data=compress(json.dumps(SENTRY_SDK_1_45_0_ERROR).encode("utf-8")),
+    )
+    assert resp.status_code == 413
+
+
+@pytest.mark.parametrize(
+    "content_encoding, compress",
+    [
+        ("gzip", gzip.compress),
+        ("deflate", zlib.compress),
+    ],
+)
+def test_store_view_compressed_truncated(client, content_encoding, compress):
+    data = compress(json.dumps(SENTRY_SDK_1_45_0_ERROR).encode("utf-8"))
+    resp = client.post(
+        "/api/1/store/",
+        content_type="application/json",
+        headers={"Content-Encoding": content_encoding},
+        data=data[:-10],
+    )
+    assert resp.status_code == 400
+
+    resp = client.get("/api/eventlist/")
+    assert resp.json["events"] == []
+
+
+@pytest.mark.parametrize("read_buffer_size", [7, 128 * 1024])
+def test_envelope_view_gzip_multiple_members(client, monkeypatch, read_buffer_size):
+    # Make sure members that straddle reads are handled, too
+    monkeypatch.setattr(kent.app, "READ_BUFFER_SIZE", read_buffer_size)
+    envelope_header = b'{"event_id":"b5a2369b82c7421eb5c118a3151da03e"}\n'
+    item_one = b'{"type":"event"}\n{"message":"one"}\n'
+    item_two = b'{"type":"event"}\n{"message":"two"}\n'
+    resp = client.post(
+        "/api/1/envelope/",
+        content_type="application/octet-stream",
+        headers={"Content-Encoding": "gzip"},
+        data=gzip.compress(envelope_header + item_one) + gzip.compress(item_two),
+    )
+    assert resp.status_code == 200
+
+    resp = client.get("/api/eventlist/")
+    assert [event["summary"] for event in resp.json["events"]] == ["one", "two"]
+
+
 def test_envelope_view(client):
     resp = client.post(
         "/api/1/envelope/",
@@ -242,6 +502,25 @@ def test_envelope_view(client):
     }
 
 
+def test_envelope_view_attachment(client):
+    resp = client.post(
+        "/api/1/envelope/",
+        content_type="application/octet-stream",
+        data=(
+            b'{"event_id":"9ec79c33ec9942ab8353589fcb2e04dc"}\n'
+            b'{"type":"attachment","length":10,"content_type":"text/plain","filename":"hello.txt"}\n'
+            b"\xef\xbb\xbfHello\r\n\n"
+        ),
+    )
+    assert resp.status_code == 200
+
+    resp = client.get("/api/eventlist/")
+    assert resp.json["events"][0]["summary"] == "no summary"
+
+    resp = client.get("/")
+    assert resp.status_code == 200
+
+
 # From "kent-testpost security_csp_new"
 CSP_REPORT_NEW = [
     {
@@ -271,6 +550,18 @@ def test_security_view(client):
     assert resp.status_code == 200
 
 
+def test_api_responses_sort_keys(client):
+    resp = client.post("/api/1/store/", json={"message": "m", "b": 1, "a": 2})
+    assert resp.status_code == 200
+
+    resp = client.get("/api/eventlist/")
+    event_id = resp.json["events"][0]["event_id"]
+    assert resp.data.startswith(b'{"events":[{"event_id":')
+
+    resp = client.get(f"/api/event/{event_id}")
+    assert b'"body":{"a":2,"b":1,"message":"m"}' in resp.data
+
+
 def test_api_flush_view(client):
     resp = client.post("/api/flush/")
     assert resp.status_code == 200
@@ -295,6 +586,24 @@ class TestAPIEventListView:
         resp = client.get("/api/eventlist/")
         assert len(resp.json) == 1
 
+    def test_eventlist_updates(self, client):
+        resp = client.get("/api/eventlist/")
+        assert resp.json == {"events": []}
+
+        resp = client.post("/api/1/store/", json={"message": "some message"})
+        assert resp.status_code == 200
+
+        resp = client.get("/api/eventlist/")
+        assert resp.json == {
+            "events": [
+                {
+                    "project_id": 1,
+                    "event_id": resp.json["events"][0]["event_id"],
+                    "summary": "some message",
+                }
+            ]
+        }
+
 
 class TestAPIEventView:
     def test_404(self, client):
@@ -2,7 +2,7 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
-from kent.utils import Item, parse_envelope
+from kent.utils import get_newline_index, Item, parse_envelope
 
 
 class Test_parse_envelope:
@@ -220,3 +220,52 @@ class Test_parse_envelope:
                 },
             ),
         ]
+
+    def test_bytearray_body(self):
+        # Decompressed bodies are bytearrays
+        payload = bytearray(
+            b'{"event_id":"9ec79c33ec9942ab8353589fcb2e04dc"}\n'
+            b'{"type":"attachment","length":5}\n'
+            b"hello\n"
+            b'{"type":"event","length":16}\n'
+            b'{"message":"hi"}\n'
+        )
+        items = list(parse_envelope(payload))
+
+        assert items == [
+            Item(
+                envelope_header={
+                    "event_id": "9ec79c33ec9942ab8353589fcb2e04dc",
+                },
+                header={
+                    "length": 5,
+                    "type": "attachment",
+                },
+                body=b"hello",
+            ),
+            Item(
+                envelope_header={
+                    "event_id": "9ec79c33ec9942ab8353589fcb2e04dc",
+                },
+                header={
+                    "length": 16,
+                    "type": "event",
+                },
+                body={"message": "hi"},
+            ),
+        ]
+        # Attachment bodies are copies so they don't keep the payload alive
+        assert type(items[0].body) is bytes
+
+
+class Test_get_newline_index:
+    def test_newline(self):
+        assert get_newline_index(b"abc\ndef\n", 0) == 3
+        assert get_newline_index(b"abc\ndef\n", 4) == 7
+
+    def test_carriage_return(self):
+        # \r is part of the line; only \n separates lines
+        assert get_newline_index(b"abc\r\ndef", 0) == 4
+
+    def test_no_newline(self):
+        assert get_newline_index(b"abc\ndef", 4) == 7